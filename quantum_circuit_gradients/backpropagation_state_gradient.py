@@ -1,94 +1,405 @@
 """A class to compute gradients of expectation values."""
 
+import os
+import atexit
+import hashlib
+import weakref
+import itertools
+import collections
 import concurrent.futures
-from qiskit.quantum_info import Statevector, Operator
-from qiskit.circuit import QuantumCircuit
-from .split_circuit import split
-from .gradient_lookup import analytic_gradient
+import numpy as np
+from qiskit.quantum_info import Operator
+from qiskit.circuit import QuantumCircuit, Gate, Parameter, ParameterExpression
+from ._kernels import NUMBA_AVAILABLE, apply_1q, apply_2q
 from numpy.typing import NDArray
 
+_PAULIS = {
+    "x": np.array([[0, 1], [1, 0]], dtype=complex),
+    "y": np.array([[0, -1j], [1j, 0]], dtype=complex),
+    "z": np.array([[1, 0], [0, -1]], dtype=complex),
+}
+_ROTATIONS = {"rx": "x", "ry": "y", "rz": "z", "crx": "x", "cry": "y", "crz": "z"}
+
+
+def _controlled(blocks: NDArray, control_off) -> NDArray:
+    """Embed a batch of 2x2 blocks acting on qubit 1 controlled by qubit 0 into 4x4 matrices.
+
+    control_off is the value on the diagonal of the subspace where the control is 0.
+    """
+    controlled = np.zeros((len(blocks), 4, 4), dtype=blocks.dtype)
+    controlled[:, [0, 2], [0, 2]] = control_off
+    controlled[:, 1::2, 1::2] = blocks
+    return controlled
+
+
+def _rotation_matrix(name: str, angles: NDArray, dtype=np.complex128) -> NDArray:
+    """Return the batch of matrices of a (controlled) Pauli rotation gate by its Qiskit name."""
+    pauli = _PAULIS[_ROTATIONS[name]].astype(dtype)
+    angles = np.asarray(angles, dtype=np.finfo(dtype).dtype)[:, None, None]
+    rotation = np.cos(angles / 2) * np.eye(2, dtype=dtype) - 1j * np.sin(angles / 2) * pauli
+    if name.startswith("c"):
+        return _controlled(rotation, 1)
+    return rotation
+
+
+# the rotations satisfy dR(angle)/dangle = -i/2 G R(angle) with these generators G, the
+# controlled ones only act where the control is 1
+_GENERATORS = {name: _controlled(_PAULIS[pauli][None], 0)[0] if name.startswith("c") else _PAULIS[pauli]
+               for name, pauli in _ROTATIONS.items()}
+
+
+def _apply_gate(state: NDArray, gate_matrix: NDArray, qubits: list[int],
+                out: NDArray | None = None) -> NDArray:
+    """Apply a k-qubit gate to a C-contiguous batch of statevectors of shape (B, 2**n).
+
+    The gate matrix is either shared by the whole batch, with shape (2**k, 2**k), or given per
+    batch element, with shape (B, 2**k, 2**k). Qubits follow Qiskit's little-endian convention,
+    so in the (B,)+(2,)*n tensor view of the states qubit q lives on axis n - q.
+
+    The result is written to out if given, which must be a C-contiguous buffer like state that
+    does not overlap with it.
+    """
+    batch_size, k = len(state), len(qubits)
+    if NUMBA_AVAILABLE and k <= 2:
+        if out is None:
+            out = state.copy()
+        else:
+            np.copyto(out, state)
+        gate_matrix = np.broadcast_to(gate_matrix, (batch_size,) + gate_matrix.shape[-2:])
+        if k == 1:
+            apply_1q(out, gate_matrix, qubits[0])
+        else:
+            apply_2q(out, gate_matrix, qubits[0], qubits[1])
+        return out
+
+    if k == 1:
+        # view the states as (B, high, 2, low) blocks around the target qubit, no copy needed
+        low = 1 << qubits[0]
+        blocks = state.reshape(batch_size, -1, 2, low)
+        out_blocks = None if out is None else out.reshape(blocks.shape)
+        return np.matmul(gate_matrix.reshape(-1, 1, 2, 2), blocks, out=out_blocks).reshape(batch_size, -1)
+
+    n = state.shape[1].bit_length() - 1
+    axes = [n - q for q in reversed(qubits)]
+    new_axes = list(range(n + 1, n + 1 + k))
+    gate_axes = new_axes + axes
+    if gate_matrix.ndim == 3:
+        gate_axes = [0] + gate_axes
+    out_axes = list(range(n + 1))
+    for axis, new_axis in zip(axes, new_axes):
+        out_axes[axis] = new_axis
+    gate = gate_matrix.reshape(gate_matrix.shape[:-2] + (2,) * 2 * k)
+    tensor = state.reshape((batch_size,) + (2,) * n)
+    out_tensor = None if out is None else out.reshape(tensor.shape)
+    out_tensor = np.einsum(gate, gate_axes, tensor, list(range(n + 1)), out_axes,
+                           order='C', out=out_tensor)
+    return out_tensor.reshape(batch_size, -1)
 
-class BackpropagationStateGradient:
-    """A class to compute gradients of expectation values."""
 
-    def __init__(self, operator: Operator, ansatz: QuantumCircuit):
+def _inner(lam_conj: NDArray, phi: NDArray) -> NDArray:
+    """Batched <lam|phi>, given the already conjugated amplitudes of lam."""
+    return np.einsum('bi,bi->b', lam_conj, phi)
+
+
+def _evaluate(expr, parameter_binds: NDArray, param_idx: dict):
+    """Evaluate a coefficient or angle for every row of a (B, P) array of parameter binds."""
+    if not isinstance(expr, ParameterExpression):
+        return expr
+    if isinstance(expr, Parameter):
+        return parameter_binds[:, param_idx[expr]]
+    indexes = {p: param_idx[p] for p in expr.parameters}
+    return np.array([expr.bind({p: row[i] for p, i in indexes.items()}).numeric()
+                     for row in parameter_binds])
+
+
+def _accumulate_product_rule(gradients: NDArray, param_index: NDArray, num_parameters: int):
+    """Sum the (B, G) per-gate gradients into a (B, P) array ordered like the ansatz parameters."""
+    grads = np.zeros((len(gradients), num_parameters), dtype=gradients.dtype)
+    np.add.at(grads, (slice(None), param_index), gradients)
+    return grads
+
+
+def _signature(circuit: QuantumCircuit):
+    """The content of a circuit the compilation depends on, to tell whether it has been edited."""
+    return tuple(circuit.data), tuple(circuit.parameters)
+
+
+_serials = itertools.count()
+
+
+class _CompiledAnsatz:
+    """The part of BackpropagationStateGradient that only depends on the ansatz and the dtype.
+
+    It is shared between all gradients built for the same ansatz, see _compile_ansatz.
+    """
+
+    def __init__(self, ansatz: QuantumCircuit, dtype):
+        # keep our own copy, the caller may keep editing theirs
+        self.ansatz = ansatz.copy()
+        self.signature = _signature(ansatz)
+        self.dtype = dtype
+        # identifies this compilation to the worker processes, see _map_chunks
+        self.serial = next(_serials)
+        self._init_vec = np.zeros(2**ansatz.num_qubits, dtype=dtype)
+        self._init_vec[0] = 1.0
+        self._param_idx = {p: i for i, p in enumerate(ansatz.parameters)}
+
+        # the gates only depend on the structure of the ansatz, so we flatten it once into a
+        # table and only evaluate the angles and their derivatives per bind
+        self._gate_info = self._compile(ansatz)
+        self.paramlist = [[rotation[2]] for _, _, rotation in self._gate_info if rotation is not None]
+        # all our gates only have one single parameter
+        self._param_index = np.array([self._param_idx[paramlist[0]] for paramlist in self.paramlist],
+                                     dtype=int)
+        self.gradients = self._generate_gradients()
+
+    def __reduce__(self):
+        # the generated function cannot be pickled, so it is generated again on unpickling
+        return _compile_ansatz, (self.ansatz, self.dtype)
+
+    def _generate_gradients(self):
+        """Generate the function computing expectation values and gradients of this ansatz.
+
+        The gate sequence is fixed once the ansatz is known, so the forward and the backward pass
+        are unrolled into straight-line code with qubits, parameter columns and constant matrices
+        inlined. This removes the walk over the gate table and the per-gate dispatch from every
+        batch. The generated source is kept in self.gradients_source.
         """
-        Args:
-            operator (OperatorBase): The operator in the expectation value.
-            ansatz (QuantumCircuit): The ansatz in the expecation value.
-            state_in (Statevector): The initial, unparameterized state, upon which the ansatz acts.
+        namespace = {
+            "np": np, "apply_gate": _apply_gate, "inner": _inner, "rotation_matrix": _rotation_matrix,
+            "evaluate": _evaluate, "accumulate": _accumulate_product_rule,
+            "dtype": self.dtype, "init_vec": self._init_vec,
+            "param_idx": self._param_idx, "param_index": self._param_index,
+        }
+        # phi and lam are not needed anymore once the first rotation has been differentiated, so
+        # the gates up to it are never undone
+        first_rotation = next((j for j, (_, _, rotation) in enumerate(self._gate_info) if rotation is not None),
+                              len(self._gate_info))
+        evaluation, forward, backward = [], [], []
+        for j, (qubits, matrix, rotation) in enumerate(self._gate_info):
+            if rotation is None:
+                namespace[f"m{j}"] = matrix
+                if j > first_rotation:
+                    namespace[f"m{j}_dagger"] = matrix.conj().T
+                    namespace[f"m{j}_transpose"] = matrix.T
+            else:
+                name, angle, _, angle_grad, generator = rotation
+                if isinstance(angle, Parameter):
+                    evaluation.append(f"a{j} = parameter_binds[:, {self._param_idx[angle]}]")
+                else:
+                    namespace[f"angle{j}"] = angle
+                    evaluation.append(f"a{j} = evaluate(angle{j}, parameter_binds, param_idx)")
+                evaluation.append(f"m{j} = rotation_matrix({name!r}, a{j}, dtype)")
+                if j > first_rotation:
+                    evaluation += [
+                        f"m{j}_dagger = m{j}.conj().swapaxes(-1, -2)",
+                        f"m{j}_transpose = m{j}.swapaxes(-1, -2)",
+                    ]
+                namespace[f"g{j}"] = generator
+                if isinstance(angle_grad, ParameterExpression):
+                    namespace[f"angle_grad{j}"] = angle_grad
+                    evaluation.append(f"c{j} = -0.5j * evaluate(angle_grad{j}, parameter_binds, param_idx)")
+                else:
+                    namespace[f"c{j}"] = -0.5j * angle_grad
+            forward.append(f"phi = apply_gate(phi, m{j}, {qubits})")
+
+        k = len(self.paramlist)
+        for j, (qubits, _, rotation) in reversed(list(enumerate(self._gate_info))):
+            if rotation is not None:
+                # with dR/dangle = -i/2 G R only the generator has to be applied to phi, as long
+                # as the rotation has not been undone yet. gradients are reported with a flipped
+                # sign, as in SymbolicStateGradient
+                k -= 1
+                backward.append(
+                    f"grads[:, {k}] = -2 * (c{j} * inner(lam_conj, apply_gate(phi, g{j}, {qubits}, out=scratch))).real")
+            if j > first_rotation:
+                backward += [
+                    f"phi, phi_spare = apply_gate(phi, m{j}_dagger, {qubits}, out=phi_spare), phi",
+                    f"lam_conj, lam_spare = apply_gate(lam_conj, m{j}_transpose, {qubits}, out=lam_spare), lam_conj",
+                ]
+
+        lines = [
+            "def gradients(parameter_binds, op_matrix_T):",
+            "batch_size = len(parameter_binds)",
+            *evaluation,
+            "phi = np.broadcast_to(init_vec, (batch_size, len(init_vec))).copy()",
+            *forward,
+            # lam is only ever used as a bra, so we keep it conjugated and propagate it with the
+            # transposed (instead of the adjoint) gates
+            "lam_conj = (phi @ op_matrix_T).conj()",
+            # the operator is Hermitian, so <phi|op|phi> = <lam|phi> is real
+            "e = inner(lam_conj, phi).real",
+            # the derivative terms and the backward propagation write into buffers allocated once,
+            # phi and lam flip between their buffer and the spare one at every gate
+            "scratch, phi_spare, lam_spare = np.empty_like(phi), np.empty_like(phi), np.empty_like(phi)",
+            f"grads = np.empty((batch_size, {len(self.paramlist)}), dtype=e.dtype)",
+            *backward,
+            f"return e, accumulate(grads, param_index, {len(self._param_idx)})",
+        ]
+        self.gradients_source = "\n    ".join(lines) + "\n"
+        exec(compile(self.gradients_source, "<BackpropagationStateGradient>", "exec"), namespace)
+        return namespace["gradients"]
+
+    def _compile(self, circuit: QuantumCircuit, wires: list[int] | None = None):
+        """Flatten a circuit into a table of (qubits, matrix, rotation) gates.
+
+        Constant gates store their matrix, parameterized rotations store their name, angle
+        expression, parameter, the derivative of the angle by that parameter and their
+        generator, so that only the angle has to be evaluated per parameter bind.
         """
-        self.operator = operator
-        self.ansatz = ansatz
+        steps = []
+        for instruction in circuit.data:
+            qubits = [circuit.find_bit(q).index for q in instruction.qubits]
+            if wires is not None:
+                qubits = [wires[q] for q in qubits]
+            op = instruction.operation
+            if not isinstance(op, Gate) and op.definition is not None:
+                steps += self._compile(op.definition, qubits)
+            elif instruction.is_parameterized():
+                if op.name not in _ROTATIONS:
+                    raise NotImplementedError('Cannot implement for', op)
+                angle = op.params[0]
+                if len(angle.parameters) != 1:
+                    raise NotImplementedError('Only angles with a single parameter are supported:', op)
+                param = next(iter(angle.parameters))
+                generator = _GENERATORS[op.name].astype(self.dtype)
+                steps.append((qubits, None, (op.name, angle, param, angle.gradient(param), generator)))
+            else:
+                steps.append((qubits, Operator(op).data.astype(self.dtype), None))
+        return steps
 
-        self.unitaries, self.paramlist = split(self.ansatz, list(ansatz.parameters),
-                                               separate_parameterized_gates=False)
 
-    def gradients_single(self, parameter_binds: NDArray):
-        op, ansatz = self.operator, self.ansatz
+_compiled_ansatzes = weakref.WeakValueDictionary()
 
-        ulist, paramlist = self.unitaries, self.paramlist
-        num_parameters = len(ulist)
 
-        ansatz: QuantumCircuit = self._bind(ansatz, parameter_binds)  # type: ignore
+def _compile_ansatz(ansatz: QuantumCircuit, dtype) -> _CompiledAnsatz:
+    """Return the compilation of the ansatz, reusing it while any gradient of the ansatz is alive.
 
-        phi = Statevector.from_label("0"*ansatz.num_qubits).evolve(ansatz)
-        lam = phi.evolve(op)
-        e = phi.expectation_value(op)
-        grads = []
-        for j in reversed(range(num_parameters)):
-            uj = ulist[j]
+    Training loops tend to create a new gradient per batch for the same circuit, which would
+    otherwise decompose the ansatz and generate its code again every time.
+    """
+    key = (id(ansatz), dtype)
+    compiled = _compiled_ansatzes.get(key)
+    # the circuit may have been edited in place since, and ids are reused once a circuit is
+    # garbage collected, so the entry is only used if the content still matches
+    if compiled is None or compiled.signature != _signature(ansatz):
+        compiled = _compiled_ansatzes[key] = _CompiledAnsatz(ansatz, dtype)
+    return compiled
 
-            deriv = analytic_gradient(uj, paramlist[j][0])
-            for _, gate in deriv:
-                self._bind(gate, parameter_binds, inplace=True)
 
-            uj_dagger = self._bind(uj, parameter_binds).inverse()
+# the gradients every worker process keeps, by key, least recently used first
+_worker_gradients = collections.OrderedDict()
+_WORKER_CACHE_SIZE = 8
 
-            phi = phi.evolve(uj_dagger)
 
-            # TODO use projection
-            grad = 2 * sum(coeff * lam.conjugate().data.dot(phi.evolve(gate).data)
-                           for coeff, gate in deriv).real
-            grads += [grad]
+def _worker_compute(key, gradient: "BackpropagationStateGradient | None", parameter_binds: NDArray):
+    """Compute a chunk with the gradient kept under key, or return None if this worker does not have it."""
+    if gradient is not None:
+        _worker_gradients[key] = gradient
+    elif key not in _worker_gradients:
+        return None
+    _worker_gradients.move_to_end(key)
+    while len(_worker_gradients) > _WORKER_CACHE_SIZE:
+        _worker_gradients.popitem(last=False)
+    return _worker_gradients[key]._gradients_batch(parameter_binds)
 
-            if j > 0:
-                lam = lam.evolve(uj_dagger)
 
-        accumulated, unique_params = self._accumulate_product_rule(
-            list(reversed(grads)))
+_pool = None
+# the keys of the gradients that have already been sent to the workers of _pool
+_pool_keys = set()
 
-        return e, [accumulated[unique_params.index(p)] for p in list(self.ansatz.parameters)]
 
-    def gradients(self, parameter_binds: NDArray):
-        expectation_values = []
-        grads = []
-        batch_size = len(parameter_binds)
-        if batch_size <= 300:
-            map_func = map
-        else:
-            executor = concurrent.futures.ProcessPoolExecutor()
-            map_func = executor.map
+def _map_chunks(gradient: "BackpropagationStateGradient", chunks: list[NDArray]) -> list:
+    """Compute the chunks on the worker pool shared by all gradients.
+
+    Only the key of the gradient is sent with the chunks once the workers have been given the
+    gradient itself, so it is not pickled again on every call. Workers that never received it,
+    or have dropped it since, hand their chunks back and these are sent again with the gradient.
+    """
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ProcessPoolExecutor()
+    key = gradient._worker_key()
+    payload = None if key in _pool_keys else gradient
+    results = list(_pool.map(_worker_compute, itertools.repeat(key), itertools.repeat(payload), chunks))
+    _pool_keys.add(key)
+    missing = [i for i, result in enumerate(results) if result is None]
+    retried = _pool.map(_worker_compute, itertools.repeat(key), itertools.repeat(gradient),
+                        [chunks[i] for i in missing])
+    for i, result in zip(missing, retried):
+        results[i] = result
+    return results
+
+
+@atexit.register
+def _shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+        _pool_keys.clear()
+
 
-        for e, grad in map_func(self.gradients_single, parameter_binds):
-            expectation_values.append(e)
-            grads.append(grad)
+class BackpropagationStateGradient:
+    """A class to compute gradients of expectation values."""
 
-        if batch_size > 300:
-            executor.shutdown(wait=True)
+    def __init__(self, operator: Operator, ansatz: QuantumCircuit, dtype=np.complex128,
+                 parallel_threshold: int = 2**21):
+        """
+        Args:
+            operator (OperatorBase): The operator in the expectation value.
+            ansatz (QuantumCircuit): The ansatz in the expecation value.
+            state_in (Statevector): The initial, unparameterized state, upon which the ansatz acts.
+            dtype: The complex dtype of the simulated states. np.complex64 halves the memory
+                traffic at single precision.
+            parallel_threshold: The amount of work, counted as batch size times statevector
+                size times number of parameterized gates, from which batches are split across
+                a pool of worker processes.
+        """
+        self.operator = operator
+        self.ansatz = ansatz
+        self.dtype = np.dtype(dtype)
+        if not np.issubdtype(self.dtype, np.complexfloating):
+            raise ValueError(f'dtype must be a complex floating dtype such as np.complex64, got {self.dtype}')
+        self._op_matrix = self.operator.to_matrix().astype(self.dtype)
+        self.parallel_threshold = parallel_threshold
+        self._operator_digest = None
+
+        self._compiled = _compile_ansatz(self.ansatz, self.dtype)
+        self.paramlist = self._compiled.paramlist
+
+    def gradients_single(self, parameter_binds: NDArray):
+        e, grads = self._gradients_batch(np.asarray(parameter_binds)[None])
+        return e[0], grads[0]
 
-        return expectation_values, grads
+    def gradients(self, parameter_binds: NDArray):
+        parameter_binds = np.asarray(parameter_binds)
+        batch_size = len(parameter_binds)
+        num_cpus = os.process_cpu_count() or 1
+        # below the threshold the batched simulation is faster than sending the work to the pool
+        work = batch_size * len(self._op_matrix) * max(1, len(self.paramlist))
+        if num_cpus == 1 or work < self.parallel_threshold:
+            return self._gradients_batch(parameter_binds)
 
-    def _accumulate_product_rule(self, gradients):
-        grads = {}
-        for paramlist, grad in zip(self.paramlist, gradients):
-            # all our gates only have one single parameter
-            param = paramlist[0]
-            grads[param] = grads.get(param, 0) + grad
+        chunksize = max(1, batch_size // (4 * num_cpus))
+        chunks = [parameter_binds[i:i + chunksize] for i in range(0, batch_size, chunksize)]
+        expectation_values, grads = zip(*_map_chunks(self, chunks))
+        return np.concatenate(expectation_values), np.concatenate(grads)
 
-        return list(grads.values()), list(grads.keys())
+    def close(self):
+        """Shut down the worker pool used for large batches, if any.
+
+        The pool is shared by all gradients, so this also shuts it down for the others, which start
+        it again when needed. It is shut down at exit in any case.
+        """
+        _shutdown_pool()
 
+    def _worker_key(self):
+        """The key the worker processes keep this gradient under, equal for equal gradients."""
+        if self._operator_digest is None:
+            self._operator_digest = hashlib.sha256(self._op_matrix.tobytes()).hexdigest()
+        return self._compiled.serial, self._operator_digest
 
-    def _bind(self, circuit: QuantumCircuit, parameter_binds: NDArray, inplace=False):
-        parameter_indexes = [self.ansatz.parameters.data.index(p) for p in circuit.parameters]
-        return circuit.assign_parameters(parameter_binds[parameter_indexes], inplace=inplace)
+    def _gradients_batch(self, parameter_binds: NDArray):
+        """Compute expectation values and gradients for a (B, P) array of parameter binds."""
+        return self._compiled.gradients(parameter_binds, self._op_matrix.T)
@@ -85,6 +85,6 @@ def analytic_gradient(circuit: QuantumCircuit, parameter=None):
         for i, a in enumerate(product_rule_term):
             coeff *= a[0]
             summand_circuit.append(a[1], *op_context[i])
-        gradient += [[coeff, summand_circuit.copy()]]
+        gradient += [[coeff, summand_circuit]]
 
     return gradient
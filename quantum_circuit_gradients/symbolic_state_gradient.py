@@ -1,4 +1,4 @@
-from sympy import Matrix, factor_terms, signsimp, lambdify, trigsimp
+from sympy import Matrix, Symbol, factor_terms, signsimp, lambdify, trigsimp
 from sympy.simplify.simplify import sum_simplify, product_simplify
 from qiskit.quantum_info import Operator
 from qiskit.circuit import QuantumCircuit
@@ -43,20 +43,21 @@ class SymbolicStateGradient:
 
         e = (phi.adjoint() * op * phi)[0, 0]
         #e = my_simplify(e)
-        parameters = [p.sympify() for p in ansatz.parameters]
+        # the angles are real, which lets sympy resolve the conjugates of the bra when differentiating
+        parameters = [Symbol(p.name, real=True) for p in ansatz.parameters]
+        e = e.subs(dict(zip([p.sympify() for p in ansatz.parameters], parameters)))
 
-        self.lambdified_expectation_value = lambdify(
-            [parameters], e, modules="numpy")
-
-        self.lambdified_gradient = lambdify(
-            [parameters], [e.diff(p) for p in parameters], modules="numpy")
+        # a single function for the expectation value and all partial derivatives, so that the
+        # subexpressions they share are only evaluated once
+        self.lambdified_jacobian = lambdify(
+            [parameters], [e, *[e.diff(p) for p in parameters]], modules="numpy", cse=True)
 
     def gradients(self, parameter_binds: NDArray):
-        return self.lambdified_expectation_value(parameter_binds.T), -np.array(self.format_gradients(parameter_binds)).T
+        expectation_value, *gradient = self.lambdified_jacobian(parameter_binds.T)
+        return expectation_value, -np.array(self.format_gradients(gradient, len(parameter_binds))).T
 
-    def format_gradients(self, parameter_binds):
-        length = len(parameter_binds)
-        return [self.vectorize_0(partial_derivative, length) for partial_derivative in self.lambdified_gradient(parameter_binds.T)]
+    def format_gradients(self, gradient, length):
+        return [self.vectorize_0(partial_derivative, length) for partial_derivative in gradient]
 
     def vectorize_0(self, partial_derivative, length): #segurisimo existe una forma mas eficiente de arreglar el problema de los 0s
         return partial_derivative if type(partial_derivative) != int else np.zeros(length)